@@ -0,0 +1,34 @@
+"""
+Optional numba kernels for scoring answers.
+
+If numba is not installed, desc_dots is None and callers should fall back to
+the numpy implementation.
+"""
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _desc_dots(
+    v_desc: np.ndarray, v_gen: np.ndarray, answers: np.ndarray, out: np.ndarray
+):
+    """
+    Compute the desc and generic dot products for an [N x D] answer matrix in
+    one pass over the answers, writing them to the [2 x N] out array.
+    """
+    num_answers, dim = answers.shape
+    for i in range(num_answers):
+        dot_desc = 0.0
+        dot_gen = 0.0
+        for j in range(dim):
+            dot_desc += v_desc[j] * answers[i, j]
+            dot_gen += v_gen[j] * answers[i, j]
+        out[0, i] = dot_desc
+        out[1, i] = dot_gen
+
+
+desc_dots = None if njit is None else njit(cache=True, fastmath=True)(_desc_dots)
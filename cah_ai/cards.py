@@ -1,8 +1,11 @@
 import gzip
 import json
 import os
+from collections import deque
 from dataclasses import dataclass
-from typing import List, Optional
+from typing import Deque, Optional
+
+import numpy as np
 
 
 @dataclass
@@ -13,8 +16,8 @@ class Prompt:
 
 @dataclass
 class Deck:
-    prompts: List[Prompt]
-    answers: List[str]
+    prompts: Deque[Prompt]
+    answers: Deque[str]
 
     @classmethod
     def load(cls, path: Optional[str] = None) -> "Deck":
@@ -23,9 +26,27 @@ class Deck:
 
         If no path is specified, this uses the set of official cards from
         https://crhallberg.com/cah/.
+
+        Cards are stored in deques, so that they can be drawn from the front
+        and returned to the back of the deck cheaply.
         """
         if path is None:
             path = os.path.join(os.path.dirname(__file__), "cah-cards-compact.json.gz")
         with gzip.open(path, "rb") as f:
             data = json.loads(f.read())
-        return cls(prompts=[Prompt(**x) for x in data["black"]], answers=data["white"])
+        return cls(
+            prompts=deque(Prompt(**x) for x in data["black"]),
+            answers=deque(data["white"]),
+        )
+
+    def shuffle(self, rng: Optional[np.random.Generator] = None):
+        """
+        Shuffle the prompts and answers in place.
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+        # Permuting object arrays avoids swapping deque elements one at a time.
+        for cards in [self.prompts, self.answers]:
+            shuffled = rng.permutation(np.array(cards, dtype=object))
+            cards.clear()
+            cards.extend(shuffled)
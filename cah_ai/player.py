@@ -1,9 +1,11 @@
 import random
 from abc import ABC, abstractmethod
-from typing import Dict, List
+from typing import Dict, Optional, Sequence, Union
 
 import numpy as np
 
+from ._kernels import desc_dots
+
 
 class Player(ABC):
     """
@@ -15,7 +17,9 @@ class Player(ABC):
 
     The score_answers() method decides the probability distribution over
     answers, given embedding vectors for all of the strings requested by the
-    encode_*() methods.
+    encode_*() methods. Answer embeddings are passed as one matrix per key,
+    where each row corresponds to an answer, so every answer must be encoded
+    with the same keys.
     """
 
     @abstractmethod
@@ -34,16 +38,26 @@ class Player(ABC):
 
     @abstractmethod
     def score_answers(
-        self, prompt: Dict[str, np.ndarray], answers: List[Dict[str, np.ndarray]]
+        self,
+        prompt: Dict[str, np.ndarray],
+        answers: Dict[str, np.ndarray],
+        answer_texts: Sequence[str],
     ) -> np.ndarray:
         """
         Given the encodings for a prompt and the encoded answers, compute an
         array of probabilities (one for each answer).
+
+        The answers map each key from encode_answer() to an [N x D] matrix
+        with one row per answer. The original answer strings are passed as
+        answer_texts, in the same order as the rows.
         """
 
     @abstractmethod
     def choose_answer(
-        self, prompt: Dict[str, np.ndarray], answers: List[Dict[str, np.ndarray]]
+        self,
+        prompt: Dict[str, np.ndarray],
+        answers: Dict[str, np.ndarray],
+        answer_texts: Sequence[str],
     ) -> int:
         """
         Like score_answers(), but select an answer as a judge.
@@ -56,24 +70,28 @@ class LexPlayer(Player):
     """
 
     def encode_prompt(self, prompt: str) -> Dict[str, str]:
-        return {prompt: ""}
+        return {}
 
     def encode_answer(self, answer: str) -> Dict[str, str]:
-        return {answer: ""}
+        return {}
 
     def score_answers(
-        self, prompt: Dict[str, np.ndarray], answers: List[Dict[str, np.ndarray]]
+        self,
+        prompt: Dict[str, np.ndarray],
+        answers: Dict[str, np.ndarray],
+        answer_texts: Sequence[str],
     ) -> np.ndarray:
-        items = sorted(enumerate(answers), key=lambda x: list(x[1].keys())[0])
-        res = np.zeros([len(answers)])
-        res[items[0][0]] = 1
+        res = np.zeros([len(answer_texts)])
+        res[self.choose_answer(prompt, answers, answer_texts)] = 1
         return res
 
     def choose_answer(
-        self, prompt: Dict[str, np.ndarray], answers: List[Dict[str, np.ndarray]]
+        self,
+        prompt: Dict[str, np.ndarray],
+        answers: Dict[str, np.ndarray],
+        answer_texts: Sequence[str],
     ) -> int:
-        items = sorted(enumerate(answers), key=lambda x: list(x[1].keys())[0])
-        return items[0][0]
+        return min(range(len(answer_texts)), key=answer_texts.__getitem__)
 
 
 class RandomPlayer(Player):
@@ -84,14 +102,20 @@ class RandomPlayer(Player):
         return {}
 
     def score_answers(
-        self, prompt: Dict[str, np.ndarray], answers: List[Dict[str, np.ndarray]]
+        self,
+        prompt: Dict[str, np.ndarray],
+        answers: Dict[str, np.ndarray],
+        answer_texts: Sequence[str],
     ) -> np.ndarray:
-        return np.ones(len(answers)) / len(answers)
+        return np.ones(len(answer_texts)) / len(answer_texts)
 
     def choose_answer(
-        self, prompt: Dict[str, np.ndarray], answers: List[Dict[str, np.ndarray]]
+        self,
+        prompt: Dict[str, np.ndarray],
+        answers: Dict[str, np.ndarray],
+        answer_texts: Sequence[str],
     ) -> int:
-        return random.randrange(len(answers))
+        return random.randrange(len(answer_texts))
 
 
 class DescPlayer(Player):
@@ -117,6 +141,12 @@ class DescPlayer(Player):
         self.temperature = temperature
         self.guide_cah = guide_cah
 
+        # Scratch buffers reused by score_answers(). These are allocated on
+        # first use and grown when there are more answers than they can hold.
+        self._scratch_prompt = None
+        self._scratch_dots = None
+        self._scratch_scores = None
+
     def encode_prompt(self, prompt: str) -> str:
         return {
             "desc": f'{self.description} answer to Cards Against Humanity prompt, "{prompt}".',
@@ -131,25 +161,86 @@ class DescPlayer(Player):
         }
 
     def score_answers(
-        self, prompt: Dict[str, np.ndarray], answers: List[Dict[str, np.ndarray]]
+        self,
+        prompt: Dict[str, np.ndarray],
+        answers: Dict[str, np.ndarray],
+        answer_texts: Sequence[str],
     ) -> np.ndarray:
-        logs = {
-            k: np.log(
-                np.maximum(
-                    1e-5, np.array([v @ answer["generic"] for answer in answers])
-                )
-            )
-            for k, v in prompt.items()
-        }
-        scores = logs["generic"] + self.personality_power * (
-            logs["desc"] - logs["generic"]
-        )
-        scores /= max(1e-5, self.temperature)
-        scores = np.exp(scores - np.max(scores))
-        return scores / np.sum(scores)
+        answer_mat = answers["generic"]
+        num_answers, dim = answer_mat.shape
+        if (
+            self._scratch_scores is None
+            or num_answers > len(self._scratch_scores)
+            or self._scratch_prompt.shape[1] != dim
+        ):
+            capacity = max(64, num_answers)
+            self._scratch_prompt = np.empty((2, dim), dtype=np.float32)
+            self._scratch_dots = np.empty(2 * capacity, dtype=np.float32)
+            self._scratch_scores = np.empty(capacity, dtype=np.float64)
+        dots = self._scratch_dots[: 2 * num_answers].reshape(2, num_answers)
+        scores = self._scratch_scores[:num_answers]
+
+        if desc_dots is not None:
+            desc_dots(prompt["desc"], prompt["generic"], answer_mat, dots)
+        else:
+            prompt_mat = self._scratch_prompt
+            prompt_mat[0] = prompt["desc"]
+            prompt_mat[1] = prompt["generic"]
+            np.matmul(prompt_mat, answer_mat.T, out=dots)
+        return _desc_probs(dots, self.personality_power, self.temperature, scores)
+
+    @staticmethod
+    def score_answers_batch(
+        players: Sequence["DescPlayer"],
+        prompts: Sequence[Dict[str, np.ndarray]],
+        answers: Dict[str, np.ndarray],
+    ) -> np.ndarray:
+        """
+        Compute score_answers() for many players at once, given each player's
+        encoded prompt and a shared set of encoded answers.
+
+        Returns an array of probabilities of the form x[player, answer].
+        """
+        # Compute all of the dot products with a single batched matmul.
+        prompt_mats = np.stack([np.stack([p["desc"], p["generic"]]) for p in prompts])
+        dots = prompt_mats @ answers["generic"].T
+        powers = np.array([p.personality_power for p in players])[:, None]
+        temps = np.array([p.temperature for p in players])[:, None]
+        return _desc_probs(dots, powers, temps)
 
     def choose_answer(
-        self, prompt: Dict[str, np.ndarray], answers: List[Dict[str, np.ndarray]]
+        self,
+        prompt: Dict[str, np.ndarray],
+        answers: Dict[str, np.ndarray],
+        answer_texts: Sequence[str],
     ) -> int:
-        scores = self.score_answers(prompt, answers)
+        scores = self.score_answers(prompt, answers, answer_texts)
         return np.argmax(scores)
+
+
+def _desc_probs(
+    dots: np.ndarray,
+    personality_power: Union[float, np.ndarray],
+    temperature: Union[float, np.ndarray],
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Turn prompt-answer dot products into DescPlayer probabilities. This is the
+    one implementation of the scoring rule, shared by every code path.
+
+    The dots are an array of shape [..., 2, N] holding desc and generic dot
+    products, and are overwritten. The personality_power and temperature must
+    broadcast against [..., N]. If out is specified, it is used as scratch
+    space for the scores, and the returned probabilities are a new array.
+    """
+    logs = np.log(np.maximum(dots, 1e-5, out=dots), out=dots)
+    logs_desc, logs_generic = logs[..., 0, :], logs[..., 1, :]
+    if out is None:
+        out = np.empty(logs_desc.shape, dtype=np.float64)
+    scores = np.subtract(logs_desc, logs_generic, out=out)
+    scores *= personality_power
+    scores += logs_generic
+    scores /= np.maximum(1e-5, temperature)
+    scores -= scores.max(axis=-1, keepdims=True)
+    np.exp(scores, out=scores)
+    return scores / scores.sum(axis=-1, keepdims=True)
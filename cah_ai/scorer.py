@@ -1,35 +1,122 @@
-from typing import List
+import hashlib
+import os
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
+import torch
 from sentence_transformers import SentenceTransformer
 
-from .player import Player
+from .cards import Deck
+from .player import DescPlayer, Player
+
+MODEL_NAME = "all-mpnet-base-v2"
 
 
 class Scorer:
     """
     A wrapper around a semantic search model that computes feature vectors for
     Players to make decisions.
+
+    When a GPU is available, the model is run on it in half precision.
+
+    If a cache_path is specified, embeddings saved there by save_cache() are
+    loaded and reused instead of being recomputed.
     """
 
-    def __init__(self):
-        self.model = SentenceTransformer("all-mpnet-base-v2")
+    def __init__(self, cache_path: Optional[str] = None):
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model = SentenceTransformer(MODEL_NAME, device=device)
+        if device == "cuda":
+            self.model = self.model.half()
+        self.cache_path = cache_path
+        self._emb_cache: Dict[str, np.ndarray] = {}
+        self._saved_embs: Dict[int, np.ndarray] = {}
+        if cache_path is not None and os.path.exists(cache_path):
+            self._load_cache(cache_path)
+
+    def save_cache(self, path: Optional[str] = None):
+        """
+        Save all of the embeddings computed so far, keyed by text hash, so
+        that they can be reused across runs.
+
+        By default, this saves to the cache_path passed to the constructor.
+        """
+        path = path or self.cache_path
+        if path is None:
+            raise ValueError("no cache path specified")
+        embs = dict(self._saved_embs)
+        embs.update((_text_hash(k), v) for k, v in self._emb_cache.items())
+        if embs:
+            vecs = np.stack(list(embs.values()))
+        else:
+            dim = self.model.get_sentence_embedding_dimension()
+            vecs = np.zeros([0, dim], dtype=np.float16)
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                model_name=np.array(MODEL_NAME),
+                keys=np.array(list(embs.keys()), dtype=np.uint64),
+                vecs=vecs,
+            )
+
+    def _load_cache(self, path: str):
+        with np.load(path) as data:
+            if str(data["model_name"]) != MODEL_NAME:
+                # Embeddings from a different model are not comparable.
+                return
+            self._saved_embs = dict(zip(data["keys"].tolist(), data["vecs"]))
+
+    def prewarm(self, deck: Deck, players: Sequence[Player]):
+        """
+        Embed every encoding of every card in the deck for all of the players
+        up front, in one large batch.
+
+        Answers that combine multiple cards are not included.
+        """
+        texts = set()
+        for player in players:
+            for prompt in deck.prompts:
+                texts.update(player.encode_prompt(prompt.text).values())
+            for answer in deck.answers:
+                texts.update(player.encode_answer(answer).values())
+        self._encode(texts, show_progress_bar=True)
 
     def scores(
         self,
         prompt: str,
         players: List[Player],
-        answers: List[str],
+        answers: Sequence[str],
     ) -> np.ndarray:
         """
         For each player, predict the probability of each answer.
 
         Player index is the row, and answer is the column: x[player, answer].
         """
+        results = self.scores_multi(prompt, [(player, answers) for player in players])
+        return np.stack(results, axis=0)
+
+    def scores_multi(
+        self,
+        prompt: str,
+        player_answers: Sequence[Tuple[Player, Sequence[str]]],
+        return_vectors: bool = False,
+    ) -> Union[List[np.ndarray], List[Tuple[np.ndarray, Dict[str, np.ndarray]]]]:
+        """
+        Like scores(), but each player has its own list of answers.
+
+        Strings for all of the players are embedded together, and the result
+        is a list with each player's probabilities over its answers.
+
+        If return_vectors is True, each element of the list is instead a tuple
+        (probs, answers_vecs), where answers_vecs are the embedded answers that
+        were passed to the player. These follow that player's encode_answer(),
+        so they are only valid for a judge that encodes answers the same way;
+        use judge_answer_vectors() to build a judge's input from them.
+        """
         prompt_strs = set()
         enc_prompts = []
         enc_answers = []
-        for player in players:
+        for player, answers in player_answers:
             enc_prompts.append(player.encode_prompt(prompt))
             enc_answers.append([player.encode_answer(a) for a in answers])
         for p in enc_prompts:
@@ -38,20 +125,47 @@ class Scorer:
             for x in xs:
                 prompt_strs.update(x.values())
 
-        ordered_prompts = list(prompt_strs)
-        embs = self.model.encode(ordered_prompts)
-        text_to_emb = dict(zip(ordered_prompts, embs))
+        text_to_emb = self._encode(prompt_strs)
 
-        results = []
-        for player, player_prompt, player_answers in zip(
-            players, enc_prompts, enc_answers
-        ):
-            prompt_vecs = {k: text_to_emb[v] for k, v in player_prompt.items()}
-            answers_vecs = [
-                {k: text_to_emb[v] for k, v in x.items()} for x in player_answers
+        results = [None] * len(player_answers)
+        answers_vecs = [None] * len(player_answers)
+
+        # DescPlayers with the same answers share an answer matrix, so they
+        # can all be scored together. Subclasses may override the encoding or
+        # scoring, so they are scored on their own.
+        desc_groups = {}
+        for i, (player, answers) in enumerate(player_answers):
+            if type(player) is DescPlayer:
+                desc_groups.setdefault(tuple(answers), []).append(i)
+                continue
+            prompt_vecs = _prompt_vectors(enc_prompts[i], text_to_emb)
+            answers_vecs[i] = _stack_answers(enc_answers[i], text_to_emb)
+            results[i] = player.score_answers(prompt_vecs, answers_vecs[i], answers)
+        for indices in desc_groups.values():
+            group_players = [player_answers[i][0] for i in indices]
+            group_prompts = [
+                _prompt_vectors(enc_prompts[i], text_to_emb) for i in indices
             ]
-            results.append(player.score_answers(prompt_vecs, answers_vecs))
-        return np.stack(results, axis=0)
+            group_answers = _stack_answers(enc_answers[indices[0]], text_to_emb)
+            if len(indices) == 1:
+                # A single player can use the (possibly faster) unbatched path.
+                answers = player_answers[indices[0]][1]
+                probs = [
+                    group_players[0].score_answers(
+                        group_prompts[0], group_answers, answers
+                    )
+                ]
+            else:
+                probs = DescPlayer.score_answers_batch(
+                    group_players, group_prompts, group_answers
+                )
+            for i, player_probs in zip(indices, probs):
+                results[i] = player_probs
+                answers_vecs[i] = group_answers
+
+        if return_vectors:
+            return list(zip(results, answers_vecs))
+        return results
 
     def choose(self, prompt: str, player: Player, answers: List[str]) -> int:
         """
@@ -60,12 +174,145 @@ class Scorer:
         enc_prompt = player.encode_prompt(prompt)
         enc_answers = [player.encode_answer(a) for a in answers]
 
-        prompt_strs = list(
-            set(enc_prompt.values()) | set(x for a in enc_answers for x in a.values())
+        prompt_strs = set(enc_prompt.values()) | set(
+            x for a in enc_answers for x in a.values()
         )
-        embs = self.model.encode(prompt_strs)
-        text_to_emb = dict(zip(prompt_strs, embs))
+        text_to_emb = self._encode(prompt_strs)
 
-        prompt_vecs = {k: text_to_emb[v] for k, v in enc_prompt.items()}
-        answers_vecs = [{k: text_to_emb[v] for k, v in x.items()} for x in enc_answers]
-        return player.choose_answer(prompt_vecs, answers_vecs)
+        prompt_vecs = _prompt_vectors(enc_prompt, text_to_emb)
+        answers_vecs = _stack_answers(enc_answers, text_to_emb)
+        return player.choose_answer(prompt_vecs, answers_vecs, answers)
+
+    def choose_vectors(
+        self,
+        prompt: str,
+        player: Player,
+        answers: Sequence[str],
+        answers_vecs: Dict[str, np.ndarray],
+    ) -> int:
+        """
+        Like choose(), but for answers that have already been embedded using
+        the given player's encode_answer(), e.g. with answer_vectors() or
+        judge_answer_vectors().
+
+        Only the encodings of the prompt need to be embedded.
+        """
+        enc_prompt = player.encode_prompt(prompt)
+        text_to_emb = self._encode(enc_prompt.values())
+        prompt_vecs = _prompt_vectors(enc_prompt, text_to_emb)
+        return player.choose_answer(prompt_vecs, answers_vecs, answers)
+
+    def judge_answer_vectors(
+        self,
+        player: Player,
+        answers: Sequence[str],
+        played_vecs: Sequence[Tuple[Player, int, Dict[str, np.ndarray]]],
+    ) -> Dict[str, np.ndarray]:
+        """
+        Build a judge's answer matrices for played answers, reusing the vectors
+        that the answers were scored with where possible.
+
+        For each answer, played_vecs holds a tuple (player, index, answers_vecs)
+        such that the answer is row index of the answers_vecs that the player
+        was scored with, as returned by scores_multi(return_vectors=True).
+        A row is only reused if the original player encoded the answer the same
+        way as the judge. The remaining answers are embedded for the judge
+        with answer_vectors().
+        """
+        judge_encs = [player.encode_answer(a) for a in answers]
+        if not judge_encs:
+            return {}
+        keys = judge_encs[0].keys()
+        if any(x.keys() != keys for x in judge_encs):
+            raise ValueError("every answer must be encoded with the same keys")
+
+        rows = [None] * len(answers)
+        missing = []
+        for i, (answer, judge_enc, (orig_player, index, answers_vecs)) in enumerate(
+            zip(answers, judge_encs, played_vecs)
+        ):
+            orig_enc = orig_player.encode_answer(answer)
+            if all(orig_enc.get(k) == v for k, v in judge_enc.items()):
+                rows[i] = {k: answers_vecs[k][index] for k in keys}
+            else:
+                missing.append(i)
+        if missing:
+            missing_vecs = self.answer_vectors(player, [answers[i] for i in missing])
+            for j, i in enumerate(missing):
+                rows[i] = {k: missing_vecs[k][j] for k in keys}
+        return {k: np.stack([x[k] for x in rows]) for k in keys}
+
+    def answer_vectors(
+        self, player: Player, answers: Sequence[str]
+    ) -> Dict[str, np.ndarray]:
+        """
+        Embed the answers for the given player, in the format expected by
+        Player.score_answers() and Player.choose_answer().
+        """
+        enc_answers = [player.encode_answer(a) for a in answers]
+        text_to_emb = self._encode(x for a in enc_answers for x in a.values())
+        return _stack_answers(enc_answers, text_to_emb)
+
+    def _encode(
+        self, texts: Iterable[str], show_progress_bar: bool = False
+    ) -> Dict[str, np.ndarray]:
+        """
+        Embed the unique texts, only running the model on texts that are not
+        already in the cache.
+
+        Embeddings are normalized, so dot products are cosine similarities.
+        They are stored as float16 to save memory, and should be converted to
+        float32 before doing math with them.
+        """
+        texts = set(texts)
+        misses = []
+        for x in texts:
+            if x in self._emb_cache:
+                continue
+            saved = self._saved_embs.get(_text_hash(x))
+            if saved is None:
+                misses.append(x)
+            else:
+                self._emb_cache[x] = saved
+        if misses:
+            embs = self.model.encode(
+                misses,
+                batch_size=256,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=show_progress_bar,
+            )
+            embs = np.ascontiguousarray(embs, dtype=np.float16)
+            self._emb_cache.update(zip(misses, embs))
+        return {x: self._emb_cache[x] for x in texts}
+
+
+def _text_hash(text: str) -> int:
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _prompt_vectors(
+    enc_prompt: Dict[str, str], text_to_emb: Dict[str, np.ndarray]
+) -> Dict[str, np.ndarray]:
+    return {k: text_to_emb[v].astype(np.float32) for k, v in enc_prompt.items()}
+
+
+def _stack_answers(
+    enc_answers: List[Dict[str, str]], text_to_emb: Dict[str, np.ndarray]
+) -> Dict[str, np.ndarray]:
+    """
+    Convert per-answer encodings into one contiguous float32 [N x D] matrix
+    per key, where the rows follow the order of the answers.
+    """
+    if not enc_answers:
+        return {}
+    keys = enc_answers[0].keys()
+    if any(x.keys() != keys for x in enc_answers):
+        raise ValueError("every answer must be encoded with the same keys")
+    return {
+        k: np.ascontiguousarray(
+            np.stack([text_to_emb[x[k]] for x in enc_answers]), dtype=np.float32
+        )
+        for k in keys
+    }
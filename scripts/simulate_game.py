@@ -4,13 +4,13 @@ long-played game of CAH.
 """
 
 import itertools
-import random
 from typing import List, Tuple
 
 import numpy as np
 from cah_ai import Deck, DescPlayer, RandomPlayer, Scorer
 
 NUM_CARDS = 10
+CACHE_PATH = "embedding_cache.npz"
 
 
 def main():
@@ -23,49 +23,68 @@ def main():
 
     print("Setting up deck...")
     deck = Deck.load()
-    random.shuffle(deck.answers)
-    random.shuffle(deck.prompts)
+    deck.shuffle()
+
+    print("Creating scorer model...")
+    scorer = Scorer(cache_path=CACHE_PATH)
+
+    print("Embedding cards...")
+    scorer.prewarm(deck, players)
+    scorer.save_cache()
 
     print("Dealing...")
     player_hands = []
     for _ in players:
-        player_hands.append(deck.answers[:NUM_CARDS])
-        deck.answers = deck.answers[NUM_CARDS:]
-
-    print("Creating scorer model...")
-    scorer = Scorer()
+        player_hands.append([deck.answers.popleft() for _ in range(NUM_CARDS)])
 
     print("Simulating game...")
     tally = [0] * len(players)
     judge = 0
     while len(deck.prompts):
         prompt = deck.prompts.pop()
+        judge_player = players[judge]
+        played_players = [i for i in range(len(players)) if i != judge]
+
+        # Brute-force pick the best combination of answer cards.
+        # Usually the answer is just one card, but not always.
+        player_combos = [
+            answer_combinations(player_hands[i], prompt.pick) for i in played_players
+        ]
+        all_results = scorer.scores_multi(
+            prompt.text,
+            [
+                (players[i], combos)
+                for i, (combos, _) in zip(played_players, player_combos)
+            ],
+            return_vectors=True,
+        )
+
         played_answers = []
-        played_players = []
-        for i, (player, hand) in enumerate(zip(players, player_hands)):
-            if i == judge:
-                continue
-
-            # Brute-force pick the best combination of answer cards.
-            # Usually the answer is just one card, but not always.
-            combos, indices = answer_combinations(hand, prompt.pick)
-            probs = scorer.scores(prompt.text, [player], combos)[0]
+        played_vecs = []
+        for i, (combos, indices), (probs, answers_vecs) in zip(
+            played_players, player_combos, all_results
+        ):
+            hand = player_hands[i]
             choice = np.random.choice(len(probs), p=probs)
             played_answers.append(combos[choice])
-            played_players.append(i)
+            played_vecs.append((players[i], choice, answers_vecs))
 
             for i in sorted(indices[choice], reverse=True):
                 deck.answers.append(hand[i])
                 del hand[i]
             while len(hand) < NUM_CARDS:
-                hand.append(deck.answers.pop(0))
+                hand.append(deck.answers.popleft())
 
         print("-----")
         print(prompt)
         print(played_answers)
 
-        judge_player = players[judge]
-        best = scorer.choose(prompt.text, judge_player, played_answers)
+        judge_vecs = scorer.judge_answer_vectors(
+            judge_player, played_answers, played_vecs
+        )
+        best = scorer.choose_vectors(
+            prompt.text, judge_player, played_answers, judge_vecs
+        )
         if best >= judge:
             best += 1
         print(f"judge={judge} best={best}")
@@ -74,16 +93,16 @@ def main():
 
         print("win tally:", tally)
 
+    scorer.save_cache()
+
 
 def answer_combinations(
     hand: List[str], pick: int
-) -> Tuple[List[str], List[List[int]]]:
+) -> Tuple[List[str], List[Tuple[int, ...]]]:
     strs = []
     indices = []
-    for combo in itertools.product(*([range(len(hand))] * pick)):
-        if len(set(combo)) != len(combo):
-            # Using one card multiple times.
-            continue
+    # Order matters for multi-pick prompts, so use permutations.
+    for combo in itertools.permutations(range(len(hand)), pick):
         strs.append(" ".join(hand[i] for i in combo))
         indices.append(combo)
     return strs, indices
@@ -3,5 +3,6 @@ from setuptools import setup
 setup(
     name="cah-ai",
     py_modules=["cah_ai"],
-    install_requires=["sentence_transformers", "numpy"],
+    install_requires=["sentence_transformers", "numpy", "torch"],
+    extras_require={"numba": ["numba"]},
 )